@@ -0,0 +1,29 @@
+from gb import Gameboy
+import sys
+import time
+
+# Frames per second for a rom with every frame drawn, every 4th frame drawn
+# and no frames drawn. The rom runs headless with no save file.
+def bench(rom_file, frames, frameskip, warmup=60):
+    game = Gameboy()
+    game.load_rom(rom_file)
+    for i in range(warmup):
+        game.step_frame()
+    game.set_frameskip(frameskip)
+    start = time.time()
+    for i in range(frames):
+        game.step_frame()
+    return frames / (time.time() - start)
+
+def main(rom_file, frames):
+    for name, frameskip in (('render every frame', 1), ('render every 4th frame', 4), ('render off', 0)):
+        print("%-24s %8.1f fps" % (name, bench(rom_file, frames, frameskip)))
+
+if __name__ == "__main__":
+    rom = "Tetris.gb"
+    frames = 300
+    if len(sys.argv) > 1:
+        rom = sys.argv[1]
+    if len(sys.argv) > 2:
+        frames = int(sys.argv[2])
+    main(rom, frames)
@@ -17,49 +17,28 @@ class Display(object):
         self.root.bind("<KeyRelease>", self.keyReleased)
 
         self.gb = gb_obj
-
-    def update(self, pixels):
-        color_map = {
-            0: "#FFFFFF",
-            1: "#AAAAAA",
-            2: "#555555",
-            3: "#000000",
+        self.keymap = {
+            'Right': 'right',
+            'Left': 'left',
+            'Up': 'up',
+            'Down': 'down',
+            'z': 'A',
+            'x': 'B',
+            'Return': 'start',
+            'BackSpace': 'select',
             }
-        lines = ["{%s}" % ' '.join(color_map[p] for p in pix_row) for pix_row in pixels]
+
+    def update(self, shades):
+        # shades is 160 * 144 shades (0-3), as from gpu.shades()
+        color_map = ("#FFFFFF", "#AAAAAA", "#555555", "#000000")
+        lines = ["{%s}" % ' '.join([color_map[p] for p in shades[y * 160 : (y + 1) * 160]])
+                 for y in range(144)]
         self.pim.put(' '.join(lines))
 
     def keyPressed(self, event):
-        if event.keysym == 'Right':
-            self.gb.joypad.right = True
-        elif event.keysym == 'Left':
-            self.gb.joypad.left = True
-        elif event.keysym == 'Up':
-            self.gb.joypad.up = True
-        elif event.keysym == 'Down':
-            self.gb.joypad.down = True
-        elif event.keysym == 'z':
-            self.gb.joypad.A = True
-        elif event.keysym == 'x':
-            self.gb.joypad.B = True
-        elif event.keysym == 'Return':
-            self.gb.joypad.start = True
-        elif event.keysym == 'BackSpace':
-            self.gb.joypad.select = True
+        if event.keysym in self.keymap:
+            self.gb.joypad.press(self.keymap[event.keysym])
 
     def keyReleased(self, event):
-        if event.keysym == 'Right':
-            self.gb.joypad.right = False
-        elif event.keysym == 'Left':
-            self.gb.joypad.left = False
-        elif event.keysym == 'Up':
-            self.gb.joypad.up = False
-        elif event.keysym == 'Down':
-            self.gb.joypad.down = False
-        elif event.keysym == 'z':
-            self.gb.joypad.A = False
-        elif event.keysym == 'x':
-            self.gb.joypad.B = False
-        elif event.keysym == 'Return':
-            self.gb.joypad.start = False
-        elif event.keysym == 'BackSpace':
-            self.gb.joypad.select = False
+        if event.keysym in self.keymap:
+            self.gb.joypad.release(self.keymap[event.keysym])
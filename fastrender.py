@@ -0,0 +1,171 @@
+import numpy as np
+
+from gb import GPUFlags, GPUPalette
+
+class NumpyRenderer(object):
+    # Draws lines for a gb_gpu with numpy array operations in place of the
+    # per-pixel loops in write_scanline. Any number of lines is drawn at
+    # once: each array below has one row per line being drawn, so a whole
+    # frame costs about the same number of numpy calls as one line.
+    #
+    # VRAM and OAM are bytearrays, so they're read through zero-copy numpy
+    # views. Tiles and tile maps are decoded once per change to VRAM, and
+    # background and window pixels are then looked up in the decoded maps.
+    #
+    # attach() makes the gpu draw its logged lines with this (by shadowing
+    # gpu.render_lines on the instance), detach() puts it back. Lines are
+    # normally drawn a frame at a time; one line at a time the numpy calls
+    # cost more than the loops they replace. render_frame() draws all 144
+    # lines from the current registers.
+    def __init__(self, gpu):
+        self.gpu = gpu
+        self.ram = gpu.ram
+        self.vram = np.frombuffer(self.ram.vram, dtype=np.uint8)
+        self.oam = np.frombuffer(self.ram.sprite_info, dtype=np.uint8)
+        self.frame = gpu.frame_array()
+        self.cols = np.arange(160)
+        self.vram_copy = self.vram.copy()
+        self.tiles = None
+
+    def attach(self):
+        self.gpu.render_lines = self.render_lines
+
+    def detach(self):
+        del self.gpu.render_lines
+
+    def render_lines(self, lines):
+        # lines is a list of (line, registers), as logged by the gpu
+        numbers = np.array([line for line, registers in lines])
+        registers = np.array([registers for line, registers in lines]).T
+        self.frame[numbers] = self.render(numbers, registers)
+        for line, registers in lines:
+            self.gpu.line_palettes[line] = registers[5:8]
+
+    def render_frame(self):
+        # Draw every line from the current registers. Returns the gpu's
+        # framebuffer as a (144, 160) array.
+        registers = self.gpu.registers()
+        self.render_lines([(line, registers) for line in range(144)])
+        return self.frame
+
+    def refresh(self):
+        # The decoded tiles, and the tile maps decoded into whole 256x256
+        # images, are kept between calls and only worked out again when
+        # VRAM has changed since the last one
+        if self.tiles is not None and np.array_equal(self.vram, self.vram_copy):
+            return
+        self.vram_copy[:] = self.vram
+        data = self.vram[:0x1800].reshape(384, 8, 2)
+        lo = np.unpackbits(data[:, :, 0:1], axis=2)
+        hi = np.unpackbits(data[:, :, 1:2], axis=2)
+        # All 384 tiles as a (384, 8, 8) array of colour indices
+        self.tiles = (hi << 1) | lo
+        self.map_images = {}
+
+    def map_image(self, map_offset, bgset):
+        # The tile map at map_offset as a flat 256x256 image of colour
+        # indices, so that pixel (y, x) is at (y << 8) | x
+        key = (map_offset, bgset)
+        image = self.map_images.get(key)
+        if image is None:
+            tile_no = self.vram[map_offset:map_offset + 0x400].astype(np.intp)
+            # Account for different location of tileset 1
+            if not bgset:
+                tile_no[tile_no < 0x80] += 0x100
+            image = self.tiles[tile_no].reshape(32, 32, 8, 8).swapaxes(1, 2).reshape(0x10000)
+            self.map_images[key] = image
+        return image
+
+    def map_pixels(self, map_offset, y, x, lcdc):
+        # Colour indices at (y, x) of the tile map at map_offset. x is a
+        # (lines, 160) array, the rest have one value per line.
+        index = (y[:, None] << 8) | x
+        key = map_offset | ((lcdc & GPUFlags.BGSET) != 0)
+        first = key[0]
+        if (key == first).all():
+            return self.map_image(first & ~1, bool(first & 1)).take(index)
+        out = np.empty(index.shape, dtype=np.uint8)
+        for k in np.unique(key):
+            rows = key == k
+            out[rows] = self.map_image(k & ~1, bool(k & 1)).take(index[rows])
+        return out
+
+    def sprite_lines(self, lines, height):
+        # Which sprites are on each line, as a (lines, 40) bool array. height
+        # has the sprite height for each line. Only the first 10 sprites in
+        # OAM on a line count, as on the hardware.
+        y_pos = self.oam[0::4].astype(np.intp) - 16
+        on_line = (lines[:, None] >= y_pos) & (lines[:, None] < y_pos + height[:, None])
+        on_line &= np.cumsum(on_line, axis=1) <= 10
+        return on_line
+
+    def render(self, lines, registers):
+        # Pixels for the given lines, as a (len(lines), 160) uint8 array of
+        # (palette << 2) | colour index like the gpu's framebuffer.
+        # registers is as from gpu.registers(), each either a value shared
+        # by all lines or an array with one value per line.
+        n = len(lines)
+        lcdc, scy, scx, wy, wx = [
+            np.broadcast_to(np.asarray(r, dtype=np.intp), (n,)) for r in registers[:5]]
+        self.refresh()
+        # With the background off, background and window are blank
+        out = np.full((n, 160), GPUPalette.BLANK << 2, dtype=np.uint8)
+        # Colour indices of the background and window, for sprite priority
+        bg_indices = np.zeros((n, 160), dtype=np.uint8)
+
+        # Background
+        bg_on = (lcdc & GPUFlags.BGON) != 0
+        if bg_on.any():
+            map_offset = np.where(lcdc & GPUFlags.BGMAP, 0x1C00, 0x1800)
+            x = (self.cols + scx[:, None]) & 0xFF
+            bg = self.map_pixels(map_offset, (lines + scy) & 0xFF, x, lcdc)
+            bg_indices[bg_on] = bg[bg_on]
+
+        # Window
+        x_pos = wx - 7
+        win_on = bg_on & ((lcdc & GPUFlags.WINON) != 0) & (lines >= wy) & (x_pos < 160)
+        if win_on.any():
+            map_offset = np.where(lcdc & GPUFlags.WINMAP, 0x1C00, 0x1800)
+            x = self.cols - x_pos[:, None]
+            visible = win_on[:, None] & (x >= 0)
+            win = self.map_pixels(map_offset, np.maximum(lines - wy, 0), np.maximum(x, 0), lcdc)
+            bg_indices[visible] = win[visible]
+        out[bg_on] = (GPUPalette.BG << 2) | bg_indices[bg_on]
+
+        # Sprites. Every row of 8 pixels a sprite has on a line is drawn at
+        # once, and where several are opaque at the same pixel the one first
+        # in priority order (lower x, then lower index) wins. If that sprite
+        # is behind the background it only shows where the background is
+        # colour 0.
+        sp_on = (lcdc & GPUFlags.SPON) != 0
+        if sp_on.any():
+            tall = (lcdc & GPUFlags.SPSZ) != 0
+            sprite_height = np.where(tall, 16, 8)
+            on_line = self.sprite_lines(lines, sprite_height) & sp_on[:, None]
+            row, sprite_index = np.nonzero(on_line)
+            if len(row):
+                y_pos, x_pos, tile_index, sprite_flags = self.oam.reshape(40, 4)[sprite_index].astype(np.intp).T
+                pix_line = lines[row] - (y_pos - 16)
+                pix_line = np.where(sprite_flags & 0x40, sprite_height[row] - 1 - pix_line, pix_line)
+                # 8x16 sprites use the even tile of the pair on top, and the
+                # odd one below, flipped as a whole
+                tile_index = np.where(tall[row], tile_index & 0xFE, tile_index) + (pix_line >> 3)
+                index = self.tiles.reshape(384 * 8, 8)[tile_index * 8 + (pix_line & 7)]
+                index = np.where((sprite_flags & 0x20)[:, None], index[:, ::-1], index)
+                x = x_pos[:, None] - 8 + np.arange(8)
+                opaque = (x >= 0) & (x < 160) & (index != 0)
+                pair, col = np.nonzero(opaque)
+                pos = row[pair] * 160 + x[pair, col]
+                priority = x_pos[pair] * 64 + sprite_index[pair]
+                order = np.lexsort((priority, pos))
+                pos = pos[order]
+                first = np.ones(len(pos), dtype=bool)
+                first[1:] = pos[1:] != pos[:-1]
+                pos = pos[first]
+                pair = pair[order][first]
+                index = index[pair, col[order][first]]
+                sprite_flags = sprite_flags[pair]
+                show = ((sprite_flags & 0x80) == 0) | (bg_indices.ravel()[pos] == 0)
+                pallette = np.where(sprite_flags & 0x10, GPUPalette.OBJ1, GPUPalette.OBJ0)
+                out.ravel()[pos[show]] = ((pallette << 2) | index)[show]
+        return out
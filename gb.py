@@ -1,24 +1,65 @@
-import sys
+import os
+import mmap
+import struct
+import time
+import atexit
+import weakref
+import collections
 
 class Gameboy:
     def __init__(self):
         self.cpu = gb_cpu()
         self.ram = self.cpu.ram
         self.gpu = gb_gpu(self.cpu, self.ram)
-        self.joypad = gb_joypad()
-        self.ram.joypad_obj = self.joypad
+        self.timer = gb_timer(self.cpu, self.ram)
+        self.serial = gb_serial(self.cpu, self.ram)
+        self.joypad = gb_joypad(self.cpu, self.ram)
 
     def step_instruction(self):
         self.cpu.step()
-        self.gpu.update(self.cpu.dt)
 
     def step_frame(self):
-        end_clock = self.cpu.clock + 70224
+        self.run_until(self.cpu.clock + 70224)
+        self.end_frame()
+
+    def run_until(self, end_clock):
         while self.cpu.clock < end_clock:
             self.step_instruction()
 
-    def load_rom(self, fname):
-        self.ram.load_rom(fname)
+    def end_frame(self):
+        # Once a frame housekeeping
+        self.ram.autosave(self.cpu.clock)
+        self.serial.flush()
+
+    def set_frameskip(self, n):
+        # Draw every nth frame, or with n = 0 only the frames asked for with
+        # request_frame. Timing, LY, STAT and interrupts are the same either
+        # way; skipped frames just aren't drawn.
+        self.gpu.render_every = n
+
+    def request_frame(self):
+        # Draw the next frame even if it would be skipped
+        self.gpu.requested = True
+
+    def get_frame(self):
+        # The last finished frame, as gpu.pixels (colour indices and
+        # palettes, gpu.shades() and gpu.rgb() give colours). If it was
+        # skipped, the screen is drawn now from the current registers and
+        # VRAM, which is the same unless the game changed them during the
+        # frame.
+        if not self.gpu.drawn:
+            self.gpu.render_frame()
+        return self.gpu.pixels
+
+    # With save=True, battery backed RAM is kept in a .sav file next to the
+    # rom. Without it (or if the file can't be opened) nothing is written.
+    def load_rom(self, fname, save=False):
+        self.ram.load_rom(fname, save)
+
+    def close(self):
+        # Write out any unsaved battery backed RAM and serial output
+        self.ram.close_save()
+        self.serial.flush()
 
 class Flags:
     Z = 0x80
@@ -44,9 +85,12 @@ class gb_cpu(object):
         self.halted = False
         self.interrupts = False
         self.ram = gb_ram()
+        self.ram.cpu_obj = self
 
-        self.timer_div_countdown = 256
-        self.timer_counter_countdown = None
+        # Scheduled events, as name -> (clock, callback). next_event is the
+        # earliest clock among them, so step() only compares against that.
+        self.events = {}
+        self.next_event = float('inf')
 
         # Debugging info
         self.used_ops = set()
@@ -402,7 +446,8 @@ H: %02x   L: %02x   Ints: %s
         else:
             self.dt = 4
             self.clock += 4
-        self.update_clock()
+        if self.clock >= self.next_event:
+            self.run_events()
 
     def check_interrupts(self):
         if not self.interrupts:
@@ -446,48 +491,35 @@ H: %02x   L: %02x   Ints: %s
         self.dt = op_details[2]
         self.used_ops.add(op)
 
-    def update_clock(self):
-        # update divider register
-        self.timer_div_countdown -= self.dt
-        if self.timer_div_countdown <= 0:
-            div = self.ram.read(0xFF04)
-            self.ram.write(0xFF04, (div + 1) & 0xFF)
-            self.timer_div_countdown += 256
-
-        # Timer register
-        control = self.ram.read(0xFF07)
-        timer_on = (control & 0x4) >> 2
-        timer_spd = (control & 3)
-        if timer_spd == 0:
-            timer_period = 1024
-        elif timer_spd == 1:
-            timer_period = 16
-        elif timer_spd == 2:
-            timer_period = 64
+    def schedule(self, name, when, callback):
+        # Call callback(when) once the clock reaches when. Scheduling a name
+        # again replaces its pending event.
+        old = self.events.get(name)
+        self.events[name] = (when, callback)
+        if when <= self.next_event:
+            self.next_event = when
+        elif old is not None and old[0] == self.next_event:
+            # Moved the earliest event later
+            self.update_next_event()
+
+    def cancel(self, name):
+        if self.events.pop(name, None) is not None:
+            self.update_next_event()
+
+    def update_next_event(self):
+        if self.events:
+            self.next_event = min(e[0] for e in self.events.values())
         else:
-            timer_period = 256
-        if timer_on:
-            if self.timer_counter_countdown is None:
-                self.timer_counter_countdown = timer_period
-            self.timer_counter_countdown -= self.dt
-            if self.timer_counter_countdown <= 0:
-                self.timer_counter_countdown += timer_period
-                counter = self.ram.read(0xFF05)
-                if counter == 0xFF:
-                    modulo = self.ram.read(0xFF06)
-                    self.ram.write(0xFF05, modulo)
-                    self.int_timer()
-                else:
-                    self.ram.write(0xFF05, counter + 1)
+            self.next_event = float('inf')
 
-        if self.ram.mbc_type == 3:
-            # MBC3 real time clock
-            if (self.ram.mbc3_rtc_dh & 0x40) == 0:
-                # Not halted
-                self.ram.mbc3_rtc_countdown -= self.dt
-                if self.ram.mbc3_rtc_countdown <= 0:
-                    self.ram.mbc3_rtc_countdown += self.ram.mbc3_rtc_cycles_per_second
-                    self.ram.mbc3_rtc_count += 1
+    def run_events(self):
+        while self.next_event <= self.clock:
+            for name, (when, callback) in self.events.items():
+                if when == self.next_event:
+                    break
+            del self.events[name]
+            self.update_next_event()
+            callback(when)
 
     def op_00(self):
         # NOP
@@ -3876,15 +3908,31 @@ H: %02x   L: %02x   Ints: %s
 
 class gb_ram(object):
     def __init__(self):
-        self.joypad_obj = None # joypad obj for input register
-        self.rom = [] # Cartridge ROM
-        self.vram = [0x00] * 0x2000 # Video RAM
-        self.eram = [0x00] * 0x8000 # External RAM
+        self.cpu_obj = None # cpu obj, for timing of memory side effects
+        self.gpu_obj = None # gpu obj, which draws logged lines before VRAM/OAM change
+        self.rom_banks = [] # Cartridge ROM split into 16K banks
+        self.rom_bank0 = None # Bank mapped at 0x0000-0x3FFF
+        self.rom_bankn = None # Bank mapped at 0x4000-0x7FFF
+        self.rom0_index = 0 # Bank number of rom_bank0
+        self.romn_index = 1 # Bank number of rom_bankn
+        self.vram = bytearray(0x2000) # Video RAM
+        self.dirty_tiles = set(range(384)) # Tiles written since the GPU last decoded them
+        self.eram = bytearray() # External RAM, sized from the cartridge header
+        self.eram_offset = -0xA000 # Added to an address to index the selected eram bank
+        self.eram_mapped = True # False when eram reads/writes need special handling
         self.iram = [0x00] * 0x2000 # Internal RAM
-        self.sprite_info = [0x00] * 0xA0
+        self.sprite_info = bytearray(0xA0) # OAM
+        self.oam_dirty = True # OAM written since the GPU last looked at it
         self.zram = [0x00] * 0x80 # Zero-page RAM
+        self.dma_end = 0 # Clock at which the running OAM DMA finishes
+        self.dma_cycles = 640 # 160 bytes at one byte per machine cycle
 
         self.mmio = [0x00] * 0x80 # Memory mapped IO
+        # Handlers for IO registers with side effects or values worked out
+        # when they're read. Registers without one just use mmio.
+        self.io_read = [None] * 0x80 # io_read[r]() gives the value of 0xFF00 + r
+        self.io_write = [None] * 0x80 # io_write[r](d) stores d to 0xFF00 + r
+        self.io_write[0x46] = self.write_dma
         # Initial MMIO values
         self.mmio[0x10] = 0x80
         self.mmio[0x11] = 0xBF
@@ -3907,18 +3955,36 @@ class gb_ram(object):
         self.mmio[0x49] = 0xFF
 
         self.mbc_type = 0 # 0 = no switching, 1/2/3/5 for MBC 1/2/3/5
+        self.ram_enabled = True # External RAM enable, always on without an MBC
+        self.eram_dirty = False # Set on every eram write, cleared when saved
+
+        # Battery backed save file
+        self.battery = False
+        self.has_rtc = False
+        self.save_file = None
+        self.save_map = None # mmap of save_file
+        self.save_interval = 4194304 # Cycles between timed saves (1 second)
+        self.save_deadline = 0 # Clock after which dirty eram is saved
 
         # MBC1 registers
         self.mbc1_mode = 0 # 0 = 16/8 mode, 1 = 4/32 mode
-        self.mbc1_rom_bank = 1 # 5/7 bit rom bank index
-        self.mbc1_ram_bank = 0 # 2 bit ram bank index
+        self.mbc1_rom_bank = 1 # Low 5 bits of the rom bank index, never 0
+        self.mbc1_ram_bank = 0 # 2 bit ram bank index, or upper rom bank bits
+
+        # MBC2 registers
+        self.mbc2_rom_bank = 1 # 4 bit rom bank index, never 0
 
         # MBC3 registers
         self.mbc3_rom_bank = 1
         self.mbc3_ram_bank = 0 # Also holds selected RTC register
-        self.mbc3_rtc_count = 0 # Ticks except when halt flag is set in dh
+        # The real time clock isn't ticked, it's worked out from the cpu clock
+        # when the game latches or writes it
         self.mbc3_rtc_cycles_per_second = 4194304
-        self.mbc3_rtc_countdown = self.mbc3_rtc_cycles_per_second
+        self.mbc3_rtc_base = 0 # Clock time in cycles as of mbc3_rtc_base_clock
+        self.mbc3_rtc_base_clock = 0 # cpu clock when the time was last set
+        self.mbc3_rtc_flags = 0 # Halt (0x40) and day carry (0x80) bits of dh
+        self.rtc_wall_clock = False # Add real time passed while saved on load
+        # Latched clock registers, as seen by the game
         self.mbc3_rtc_s = 0
         self.mbc3_rtc_m = 0
         self.mbc3_rtc_h = 0
@@ -3926,22 +3992,248 @@ class gb_ram(object):
         self.mbc3_rtc_dh = 0
         self.mbc3_latch = 0
 
-    def load_rom(self, fname):
-        rom_string = open(fname).read()
-        self.rom = [ord(c) for c in rom_string]
+        # MBC5 registers
+        self.mbc5_rom_bank = 1 # 9 bit rom bank index, 0 is allowed
+        self.mbc5_ram_bank = 0 # 4 bit ram bank index
+        self.mbc5_rumble = False # Bit 3 of the ram bank register drives a motor
+
+        self.split_rom(bytearray(0x8000))
+
+    def load_rom(self, fname, save=False):
+        self.close_save()
+        rom = bytearray(open(fname, 'rb').read())
 
         # Set up mbc
-        rom_type = self.rom[0x0147]
-        if rom_type in (0, 8, 9):
-            self.mbc_type = 0
-        elif rom_type in (1, 2, 3):
-            self.mbc_type = 1
-        elif rom_type in (5, 6):
-            self.mbc_type = 2
-        elif rom_type in (0x12, 0x13):
-            self.mbc_type = 3
-        elif rom_type in (0x19, 0x1A, 0x1B, 0x1C, 0x1D, 0x1E):
-            self.mbc_type = 5
+        rom_type = rom[0x0147]
+        self.mbc_type = self.mbc_types.get(rom_type, 0)
+        self.mbc5_rumble = rom_type in (0x1C, 0x1D, 0x1E)
+        self.ram_enabled = (self.mbc_type == 0)
+
+        self.eram = bytearray(self.eram_size(rom_type, rom[0x0149]))
+        self.eram_dirty = False
+
+        self.split_rom(rom)
+
+        self.battery = rom_type in self.battery_types
+        self.has_rtc = rom_type in (0x0F, 0x10)
+        if save and self.battery:
+            self.open_save(os.path.splitext(fname)[0] + '.sav')
+
+    # MBC for each supported cartridge type (header byte 0x147)
+    mbc_types = {
+        0x00: 0, 0x08: 0, 0x09: 0,
+        0x01: 1, 0x02: 1, 0x03: 1,
+        0x05: 2, 0x06: 2,
+        0x0F: 3, 0x10: 3, 0x11: 3, 0x12: 3, 0x13: 3,
+        0x19: 5, 0x1A: 5, 0x1B: 5, 0x1C: 5, 0x1D: 5, 0x1E: 5,
+        }
+
+    # Cartridge types with battery backed RAM
+    battery_types = (0x03, 0x06, 0x09, 0x0D, 0x0F, 0x10, 0x13, 0x1B, 0x1E)
+
+    @classmethod
+    def eram_size(cls, rom_type, ram_size):
+        # External RAM size in bytes, from header bytes 0x147 and 0x149
+        if cls.mbc_types.get(rom_type) == 2:
+            # 512 x 4 bits built into the MBC, whatever the header says
+            return 0x200
+        if ram_size < len(cls.eram_sizes):
+            return cls.eram_sizes[ram_size]
+        return 0x8000
+
+    # MBC3 clock footer appended to the RAM in save files: the current and
+    # latched s/m/h/dl/dh registers as 32 bit values, then a 64 bit unix
+    # timestamp. This is the layout other emulators use as well.
+    rtc_footer = struct.Struct('<10IQ')
+
+    def open_save(self, path):
+        # Map the save file and load external RAM (and the clock) from it.
+        # The file stays mapped so later saves are just a copy into memory.
+        size = len(self.eram)
+        if self.has_rtc:
+            size += self.rtc_footer.size
+        if size == 0:
+            return
+        f = None
+        try:
+            if os.path.exists(path):
+                f = open(path, 'r+b')
+            else:
+                f = open(path, 'w+b')
+            f.seek(0, 2)
+            if f.tell() < size:
+                f.write(b'\x00' * (size - f.tell()))
+                f.flush()
+            f.seek(0, 2)
+            save_map = mmap.mmap(f.fileno(), f.tell())
+        except (IOError, OSError, mmap.error):
+            # e.g. a read-only rom directory, so run without a save file
+            if f is not None:
+                f.close()
+            return
+        self.save_file = f
+        self.save_map = save_map
+
+        self.eram[:] = bytearray(self.save_map[0:len(self.eram)])
+        if self.has_rtc:
+            self.load_rtc(self.save_map[len(self.eram):size])
+        open_saves.add(self)
+
+    def flush_save(self):
+        # Copy external RAM into the save file if it changed since last time
+        if self.eram_dirty and self.save_map is not None:
+            n = len(self.eram)
+            self.save_map[0:n] = bytes(self.eram)
+            if self.has_rtc:
+                self.save_map[n:n + self.rtc_footer.size] = self.save_rtc()
+        self.eram_dirty = False
+
+    def autosave(self, clock):
+        # Called once a frame. Save dirty RAM at most every save_interval
+        # cycles, so games that keep writing to it don't cost a copy each time.
+        if clock >= self.save_deadline:
+            self.save_deadline = clock + self.save_interval
+            if self.eram_dirty:
+                self.flush_save()
+
+    def close_save(self):
+        if self.save_map is None:
+            return
+        # Always rewrite the clock so the time it was saved is up to date
+        self.eram_dirty = True
+        self.flush_save()
+        self.save_map.flush()
+        self.save_map.close()
+        self.save_file.close()
+        self.save_map = None
+        self.save_file = None
+        open_saves.discard(self)
+
+    def save_rtc(self):
+        return self.rtc_footer.pack(*(self.rtc_registers() + (
+                self.mbc3_rtc_s, self.mbc3_rtc_m, self.mbc3_rtc_h, self.mbc3_rtc_dl, self.mbc3_rtc_dh,
+                int(time.time()))))
+
+    def load_rtc(self, data):
+        (s, m, h, dl, dh,
+         self.mbc3_rtc_s, self.mbc3_rtc_m, self.mbc3_rtc_h, self.mbc3_rtc_dl, self.mbc3_rtc_dh,
+         timestamp) = self.rtc_footer.unpack(bytes(data))
+        seconds = ((((dh & 1) << 8 | dl) * 24 + h) * 60 + m) * 60 + s
+        if self.rtc_wall_clock and not dh & 0x40:
+            # Catch up with the time that passed since it was saved
+            seconds += max(0, int(time.time()) - timestamp)
+        self.mbc3_rtc_flags = dh & 0xC0
+        self.set_rtc(seconds * self.mbc3_rtc_cycles_per_second)
+
+    def clock_now(self):
+        if self.cpu_obj is None:
+            return 0
+        return self.cpu_obj.clock
+
+    def rtc_now(self):
+        # Current clock time in cycles
+        if self.mbc3_rtc_flags & 0x40:
+            # Halted
+            return self.mbc3_rtc_base
+        return self.mbc3_rtc_base + self.clock_now() - self.mbc3_rtc_base_clock
+
+    def set_rtc(self, cycles):
+        # Make the clock read cycles from now on. The day counter is 9 bits,
+        # overflowing it sets the carry flag until the game clears it.
+        wrap = 512 * 86400 * self.mbc3_rtc_cycles_per_second
+        if cycles >= wrap:
+            self.mbc3_rtc_flags |= 0x80
+            cycles %= wrap
+        self.mbc3_rtc_base = cycles
+        self.mbc3_rtc_base_clock = self.clock_now()
+
+    def rtc_registers(self):
+        # Current (s, m, h, dl, dh) clock registers
+        self.set_rtc(self.rtc_now())
+        seconds = self.mbc3_rtc_base // self.mbc3_rtc_cycles_per_second
+        days = seconds // 86400
+        return (seconds % 60, (seconds // 60) % 60, (seconds // 3600) % 24,
+                days & 0xFF, self.mbc3_rtc_flags | (days >> 8))
+
+    def write_rtc(self, d):
+        # Writes to the selected clock register go straight to the counter
+        cycles = self.rtc_now()
+        seconds, sub_second = divmod(cycles, self.mbc3_rtc_cycles_per_second)
+        minutes, s = divmod(seconds, 60)
+        hours, m = divmod(minutes, 60)
+        days, h = divmod(hours, 24)
+        if self.mbc3_ram_bank == 0x08:
+            s = self.mbc3_rtc_s = d & 0x3F
+            # Writing the seconds also resets the sub-second divider
+            sub_second = 0
+        elif self.mbc3_ram_bank == 0x09:
+            m = self.mbc3_rtc_m = d & 0x3F
+        elif self.mbc3_ram_bank == 0x0A:
+            h = self.mbc3_rtc_h = d & 0x1F
+        elif self.mbc3_ram_bank == 0x0B:
+            self.mbc3_rtc_dl = d
+            days = (days & 0x100) | d
+        elif self.mbc3_ram_bank == 0x0C:
+            self.mbc3_rtc_dh = d & 0xC1
+            days = (days & 0xFF) | ((d & 1) << 8)
+            self.mbc3_rtc_flags = d & 0xC0
+        else:
+            return
+        seconds = ((days * 24 + h) * 60 + m) * 60 + s
+        self.set_rtc(seconds * self.mbc3_rtc_cycles_per_second + sub_second)
+        self.eram_dirty = True
+
+    # External RAM size in bytes for each value of header byte 0x149
+    eram_sizes = (0, 0x800, 0x2000, 0x8000, 0x20000, 0x10000)
+
+    def split_rom(self, rom):
+        # Pad the ROM out to whole banks and cut it into one buffer per bank,
+        # so switching banks is just picking a different buffer. Only the
+        # banks are kept, not the whole ROM as well.
+        size = max(0x8000, (len(rom) + 0x3FFF) & ~0x3FFF)
+        rom.extend(b'\xff' * (size - len(rom)))
+        self.rom_banks = [rom[i:i + 0x4000] for i in range(0, size, 0x4000)]
+        self.update_banks()
+
+    def update_banks(self):
+        # Recompute the memory windows selected by the MBC registers. Called
+        # whenever they change, so reads and writes are plain indexes.
+        rom0 = 0
+        romn = 1
+        ram_bank = 0
+        ram_mapped = self.ram_enabled
+        if self.mbc_type == 1:
+            romn = (self.mbc1_ram_bank << 5) | self.mbc1_rom_bank
+            if self.mbc1_mode == 1:
+                # 4/32 mode: the 2 bit register also selects the ram bank and
+                # the bank seen at 0x0000-0x3FFF (for 1MB+ roms)
+                rom0 = self.mbc1_ram_bank << 5
+                ram_bank = self.mbc1_ram_bank
+        elif self.mbc_type == 2:
+            romn = self.mbc2_rom_bank
+            # 4 bit RAM, always goes through read/write_eram_unmapped
+            ram_mapped = False
+        elif self.mbc_type == 3:
+            romn = self.mbc3_rom_bank
+            if self.mbc3_ram_bank < 4:
+                ram_bank = self.mbc3_ram_bank
+            else:
+                # RTC register selected
+                ram_mapped = False
+        elif self.mbc_type == 5:
+            romn = self.mbc5_rom_bank
+            ram_bank = self.mbc5_ram_bank
+
+        rom_count = len(self.rom_banks)
+        self.rom0_index = rom0 % rom_count
+        self.romn_index = romn % rom_count
+        self.rom_bank0 = self.rom_banks[self.rom0_index]
+        self.rom_bankn = self.rom_banks[self.romn_index]
+
+        # RAM smaller than one bank (or none) goes through the unmapped path
+        ram_count = max(1, len(self.eram) // 0x2000)
+        self.eram_offset = 0x2000 * (ram_bank % ram_count) - 0xA000
+        self.eram_mapped = ram_mapped and len(self.eram) >= 0x2000
 
     def dump(self):
         output = ""
@@ -3956,12 +4248,18 @@ class gb_ram(object):
             # Zero page RAM
             return self.zram[p - 0xFF80]
         elif p >= 0xFF00:
+            reader = self.io_read[p - 0xFF00]
+            if reader is not None:
+                return reader()
             return self.mmio[p - 0xFF00]
         elif p >= 0xFEA0:
             # Nothing here
             return 0
         elif p >= 0xFE00:
             # Sprite info
+            if self.cpu_obj is not None and self.cpu_obj.clock < self.dma_end:
+                # OAM is busy while a DMA is running
+                return 0xFF
             return self.sprite_info[p - 0xFE00]
         elif p >= 0xE000:
             # Working RAM Shadow
@@ -3971,46 +4269,42 @@ class gb_ram(object):
             return self.iram[p - 0xC000]
         elif p >= 0xA000:
             # External RAM
-            if self.mbc_type == 3:
-                if self.mbc3_ram_bank < 4:
-                    return self.eram[p - 0xA000 + 0x2000 * self.mbc3_ram_bank]
-                elif self.mbc3_ram_bank == 0x08:
-                    return self.mbc3_rtc_s
-                elif self.mbc3_ram_bank == 0x09:
-                    return self.mbc3_rtc_m
-                elif self.mbc3_ram_bank == 0x0A:
-                    return self.mbc3_rtc_h
-                elif self.mbc3_ram_bank == 0x0B:
-                    return self.mbc3_rtc_dl
-                elif self.mbc3_ram_bank == 0x0C:
-                    return self.mbc3_rtc_dh
-                else:
-                    assert False, "Invalid RAM Bank number %x" % self.mbc3_ram_bank
-            else:
-                return self.eram[p - 0xA000]
+            if self.eram_mapped:
+                return self.eram[p + self.eram_offset]
+            return self.read_eram_unmapped(p)
         elif p >= 0x8000:
             # Graphics RAM
             return self.vram[p - 0x8000]
         elif p >= 0x4000:
             # ROM, switchable bank
-            # TODO - Implement all MBCs
-            if self.mbc_type == 0:
-                return self.rom[p]
-            elif self.mbc_type == 1:
-                if self.mbc1_rom_bank == 0:
-                    return self.rom[p]
-                else:
-                    return self.rom[p + 0x4000 * (self.mbc1_rom_bank - 1)]
-            elif self.mbc_type == 3:
-                if self.mbc3_rom_bank == 0:
-                    return self.rom[p]
-                else:
-                    return self.rom[p + 0x4000 * (self.mbc3_rom_bank - 1)]
-            else:
-                assert False, "This MBC type not implemented"
+            return self.rom_bankn[p - 0x4000]
         else:
             # ROM bank 0
-            return self.rom[p]
+            return self.rom_bank0[p]
+
+    def read_eram_unmapped(self, p):
+        # External RAM area when it isn't backed by a RAM bank
+        if not self.ram_enabled:
+            return 0xFF
+        if self.mbc_type == 2:
+            # Only the low nibble exists, mirrored through 0xA000-0xBFFF
+            return self.eram[(p - 0xA000) & 0x1FF] | 0xF0
+        if self.mbc_type == 3 and self.mbc3_ram_bank >= 0x08:
+            if self.mbc3_ram_bank == 0x08:
+                return self.mbc3_rtc_s
+            elif self.mbc3_ram_bank == 0x09:
+                return self.mbc3_rtc_m
+            elif self.mbc3_ram_bank == 0x0A:
+                return self.mbc3_rtc_h
+            elif self.mbc3_ram_bank == 0x0B:
+                return self.mbc3_rtc_dl
+            elif self.mbc3_ram_bank == 0x0C:
+                return self.mbc3_rtc_dh
+            return 0xFF
+        if self.eram:
+            # 2K RAM, mirrored through 0xA000-0xBFFF
+            return self.eram[(p - 0xA000) % len(self.eram)]
+        return 0xFF
 
     def write(self, p, d):
         d = d & 0xFF
@@ -4018,27 +4312,23 @@ class gb_ram(object):
             # Zero page RAM
             self.zram[p - 0xFF80] = d
         elif p >= 0xFF00:
-            self.mmio[p - 0xFF00] = d
-            if p == 0xFF00 and self.joypad_obj is not None:
-                # Input register
-                if d & 0x30 == 0x10:
-                    self.mmio[0] |= self.joypad_obj.P15_mask()
-                elif d & 0x30 == 0x20:
-                    self.mmio[0] |= self.joypad_obj.P14_mask()
-            elif p == 0xFF46:
-                # Transfer data from RAM to OAM
-                offset = self.mmio[0x46] * 0x0100
-                for i in range(0xA0):
-                    self.sprite_info[i] = self.read(offset+i)
-            elif p == 0xFF02:
-                if d & 0x80 == 0x80:
-                    sys.stdout.write(chr(self.mmio[0x01]))
+            writer = self.io_write[p - 0xFF00]
+            if writer is not None:
+                writer(d)
+            else:
+                self.mmio[p - 0xFF00] = d
         elif p >= 0xFEA0:
             # Nothing here
             return
         elif p >= 0xFE00:
             # Sprite info
+            if self.cpu_obj is not None and self.cpu_obj.clock < self.dma_end:
+                # OAM is busy while a DMA is running
+                return
+            if self.gpu_obj is not None and self.gpu_obj.pending:
+                self.gpu_obj.render_pending()
             self.sprite_info[p - 0xFE00] = d
+            self.oam_dirty = True
         elif p >= 0xE000:
             # Working RAM Shadow
             self.iram[p - 0xE000] = d
@@ -4047,77 +4337,148 @@ class gb_ram(object):
             self.iram[p - 0xC000] = d
         elif p >= 0xA000:
             # External RAM
-            if self.mbc_type == 3:
-                if self.mbc3_ram_bank < 0x4:
-                    self.eram[p - 0xA000 + 0x2000 * self.mbc3_ram_bank] = d
-                else:
-                    # Write to RTC register
-                    if self.mbc3_ram_bank == 0x8:
-                        self.mbc3_rtc_s = d
-                    elif self.mbc3_ram_bank == 0x9:
-                        self.mbc3_rtc_m = d
-                    elif self.mbc3_ram_bank == 0xA:
-                        self.mbc3_rtc_h = d
-                    elif self.mbc3_ram_bank == 0xB:
-                        self.mbc3_rtc_dl = d
-                    elif self.mbc_3_ram_bank == 0xC:
-                        self.mbc3_rtc_dh = d
-                    # Update self.mbc3_rtc_count
-                    day_count = ((self.mbc3_rtc_dh & 1) << 8) + self.mbc3_rtc_dl
-                    self.mbc3_rtc_count = day_count * 86400 + self.mbc3_rtc_h * 3600 + self.mbc3_rtc_m * 60 + self.mbc_rtc_s
+            if self.eram_mapped:
+                self.eram[p + self.eram_offset] = d
+                self.eram_dirty = True
             else:
-                self.eram[p - 0xA000] = d
+                self.write_eram_unmapped(p, d)
         elif p >= 0x8000:
             # Graphics RAM
+            if self.gpu_obj is not None and self.gpu_obj.pending:
+                self.gpu_obj.render_pending()
             self.vram[p - 0x8000] = d
+            if p < 0x9800:
+                self.dirty_tiles.add((p - 0x8000) >> 4)
         else:
             # Attempt to write into ROM area
             # Does not actually write, but interfaces with the MBC
-            # TODO - fill in
             if self.mbc_type == 1:
                 if p >= 0x6000:
                     self.mbc1_mode = d & 1
                     # print "MBC1 mode %d" % self.mbc1_mode
                 elif p >= 0x4000:
-                    if self.mbc1_mode == 0:
-                        self.mbc1_rom_bank &= 0x1F
-                        self.mbc1_rom_bank |= (d & 3) << 5
-                    else:
-                        self.mbc1_ram_bank = d & 3
-                    # print "Selected ROM bank %d" % self.mbc1_rom_bank
+                    self.mbc1_ram_bank = d & 3
                 elif p >= 0x2000:
-                    self.mbc1_rom_bank &= 0x60
-                    self.mbc1_rom_bank |= (d & 0x1F)
+                    # Bank 0 can't be selected here, it maps to bank 1
+                    self.mbc1_rom_bank = (d & 0x1F) or 1
                     # print "Selected ROM bank %d" % self.mbc1_rom_bank
                 else:
-                    # Technically should enable/disable RAM bank
-                    pass
+                    self.enable_ram(d)
+            elif self.mbc_type == 2:
+                if p >= 0x4000:
+                    # Nothing here
+                    return
+                elif p & 0x100:
+                    # Address bit 8 set selects the rom bank register
+                    self.mbc2_rom_bank = (d & 0x0F) or 1
+                else:
+                    self.enable_ram(d)
             elif self.mbc_type == 3:
                 if p >= 0x6000:
                     if d == 1 and self.mbc3_latch == 0:
                         # Latch clock data
-                        self.mbc3_rtc_s = self.mbc3_rtc_count % 60
-                        self.mbc3_rtc_m = (self.mbc3_rtc_count / 60) % 60
-                        self.mbc3_rtc_h = (self.mbc3_rtc_count / 3600) % 24
-                        self.mbc3_rtc_dl = (self.mbc3_rtc_count / 86400) & 0xFF
-                        self.mbc3_rtc_dh &= 0xFE
-                        self.mbc3_rtc_dh |= ((self.mbc3_rtc_count / 86400) >> 8) & 1
-                        if self.mbc3_rtc_count > 44236800:
-                            self.mbc3_rtc_dh |= 0x80
+                        (self.mbc3_rtc_s, self.mbc3_rtc_m, self.mbc3_rtc_h,
+                         self.mbc3_rtc_dl, self.mbc3_rtc_dh) = self.rtc_registers()
                     self.mbc3_latch = d
                 elif p >= 0x4000:
                     self.mbc3_ram_bank = d
                 elif p >= 0x2000:
-                    self.mbc3_rom_bank = d
+                    # Bank 0 can't be selected here, it maps to bank 1
+                    self.mbc3_rom_bank = (d & 0x7F) or 1
+                else:
+                    # Enables both RAM and the timer registers
+                    self.enable_ram(d)
+            elif self.mbc_type == 5:
+                if p >= 0x6000:
+                    # Nothing here
+                    return
+                elif p >= 0x4000:
+                    if self.mbc5_rumble:
+                        self.mbc5_ram_bank = d & 0x07
+                    else:
+                        self.mbc5_ram_bank = d & 0x0F
+                elif p >= 0x3000:
+                    self.mbc5_rom_bank = (self.mbc5_rom_bank & 0xFF) | ((d & 1) << 8)
+                elif p >= 0x2000:
+                    # Unlike MBC1/3, bank 0 can be mapped here
+                    self.mbc5_rom_bank = (self.mbc5_rom_bank & 0x100) | d
                 else:
-                    # Technically should enable RAM and timer, we'll just have them always on for convenience
-                    pass
+                    self.enable_ram(d)
             elif self.mbc_type == 0:
                 # Do nothing
-                pass
+                return
             else:
                 assert False, "MBC type %d not implemented" % self.mbc_type
+            self.update_banks()
+
+    def write_dma(self, d):
+        # Transfer data from RAM to OAM
+        self.mmio[0x46] = d
+        self.oam_dma(d)
+
+    def enable_ram(self, d):
+        # RAM enable register, common to all the MBCs
+        self.ram_enabled = (d & 0x0F) == 0x0A
+        if not self.ram_enabled and self.eram_dirty:
+            # Games disable RAM once they're done writing a save
+            self.flush_save()
+
+    def write_eram_unmapped(self, p, d):
+        # External RAM area when it isn't backed by a RAM bank
+        if not self.ram_enabled:
             return
+        if self.mbc_type == 2:
+            self.eram[(p - 0xA000) & 0x1FF] = d & 0x0F
+            self.eram_dirty = True
+            return
+        if self.mbc_type == 3 and self.mbc3_ram_bank >= 0x08:
+            self.write_rtc(d)
+        elif self.eram:
+            # 2K RAM, mirrored through 0xA000-0xBFFF
+            self.eram[(p - 0xA000) % len(self.eram)] = d
+            self.eram_dirty = True
+
+    def dma_source(self, src):
+        # Find the buffer and index that back address src for a whole DMA
+        # block, or (None, 0) if the block can't be read as one slice
+        if src >= 0xE000:
+            # Working RAM shadow
+            src -= 0x2000
+        if src >= 0xC000:
+            return self.iram, src - 0xC000
+        elif src >= 0xA000:
+            if self.eram_mapped:
+                return self.eram, src + self.eram_offset
+            return None, 0
+        elif src >= 0x8000:
+            return self.vram, src - 0x8000
+        elif src >= 0x4000:
+            return self.rom_bankn, src - 0x4000
+        return self.rom_bank0, src
+
+    def oam_dma(self, d):
+        # Copy 0xA0 bytes from d * 0x100 into OAM in one go. The CPU keeps
+        # running during the transfer, but OAM reads as 0xFF until it's done.
+        src = d << 8
+        if self.gpu_obj is not None and self.gpu_obj.pending:
+            self.gpu_obj.render_pending()
+        buf, start = self.dma_source(src)
+        if buf is not None:
+            self.sprite_info[:] = buf[start:start + 0xA0]
+        else:
+            self.sprite_info[:] = [self.read(src + i) for i in range(0xA0)]
+        self.oam_dirty = True
+        if self.cpu_obj is not None:
+            self.dma_end = self.cpu_obj.clock + self.dma_cycles
+
+# Every gb_ram with an open save file, written out when python exits
+open_saves = weakref.WeakSet()
+
+def close_open_saves():
+    for ram in list(open_saves):
+        ram.close_save()
+
+atexit.register(close_open_saves)
 
 class GPUFlags:
     BGON = 0x01 # Background on
@@ -4129,219 +4490,641 @@ class GPUFlags:
     WINMAP = 0x40 # Window tilemap
     DISPON = 0x80 # Display on
 
+class GPUPalette:
+    # Palette part of a framebuffer pixel, which is (palette << 2) | colour index
+    BG = 0 # BGP
+    OBJ0 = 1 # OBP0
+    OBJ1 = 2 # OBP1
+    BLANK = 3 # Always shade 0, for lines with the background off
+
 class gb_gpu(object):
+    # Timing, in cycles. Each of the 154 lines takes 456 cycles: 80 in mode 2
+    # (OAM read), 172 in mode 3 (VRAM read) and the rest in mode 0 (HBLANK).
+    # Lines 144-153 are VBLANK (mode 1).
+    line_cycles = 456
+    frame_cycles = 154 * 456
+    hblank_start = 80 + 172
+
     def __init__(self, cpu_obj, ram_obj):
         self.cpu = cpu_obj
         self.ram = ram_obj
-        self.modeclock = 0
-        self.mode = 0
-        self.line = 0
-        self.pixels = [None] * 144
-        for i in range(144):
-            self.pixels[i] = [0x0] * 160
+        self.frame_start = 0 # Clock at which line 0 of the current frame began
+        self.line = 0 # Last line to reach HBLANK
+        # The screen, 160 pixels per line from the top. Each pixel is a
+        # colour index and the palette it goes through, as (palette << 2) |
+        # index (see GPUPalette), and the palette registers each line was
+        # drawn with are in line_palettes. shades() and rgb() turn that into
+        # colours for the whole screen at once. pixels is the same memory as
+        # a memoryview, for anything that takes a buffer (numpy, hashes,
+        # files) without copying it.
+        self.framebuffer = bytearray(160 * 144)
+        self.pixels = memoryview(self.framebuffer)
+        self.line_palettes = [(0, 0, 0)] * 144 # (BGP, OBP0, OBP1) per line
+        self.palette_tables = {} # line_palettes entry -> translate table
+        # Decoded rows of the 384 tiles, tile_rows[tile * 8 + row], filled
+        # in from ram.dirty_tiles before each line is drawn
+        self.tile_rows = [None] * (384 * 8)
+        self.tile_rows_flipped = [None] * (384 * 8)
+        # Lines are drawn in batches, normally all at once at VBLANK. Each
+        # line logs the registers it's drawn with here at the end of its
+        # mode 3, and anything that changes VRAM or OAM draws the logged
+        # lines first, so mid-frame changes still show on the right lines.
+        self.pending = [] # (line, registers) not drawn yet
+
+        # Frames can be skipped, in which case nothing is logged or drawn
+        self.render_every = 1 # Draw every nth frame, 0 for only requested ones
+        self.requested = False # Draw the next frame regardless
+        self.frames = 0 # Frames finished
+        self.drawing = True # Whether this frame is being drawn
+        self.drawn = True # Whether pixels holds the last finished frame
+        self.ram.gpu_obj = self
+        self.line_sprites = None # From sprite_lines()
+        self.sprite_height = None # Sprite height line_sprites is for
+
+        # LY and STAT are worked out from the clock when they're read, so
+        # the GPU only has to run at the end of each visible line and at
+        # the start of VBLANK
+        self.ram.io_read[0x41] = self.read_stat
+        self.ram.io_write[0x41] = self.write_stat
+        self.ram.io_read[0x44] = self.read_ly
+        self.ram.io_write[0x44] = self.write_ly
+        # With the LCD off (LCDC bit 7) nothing is scheduled at all, LY
+        # stays at 0, and the frame restarts from line 0 when it's turned on
+        self.ram.io_write[0x40] = self.write_lcdc
+        self.enabled = bool(self.ram.mmio[0x40] & GPUFlags.DISPON)
+        if self.enabled:
+            self.schedule_hblank(0)
+        # The STAT interrupt is scheduled for the next time one of the
+        # sources enabled in STAT comes on, see schedule_stat
+        self.ram.io_write[0x45] = self.write_lyc
 
     def __str__(self):
+        line, mode = self.position()
         return """
 GPU Mode: %d    Mode Clock: %d    Line: %3d (%02x)
-""" % (self.mode, self.modeclock, self.line, self.line)
+""" % (mode, (self.cpu.clock - self.frame_start) % self.line_cycles, line, line)
 
     def pixmap_str(self):
-        return '\n'.join(''.join(str(p) for p in pix_row) for pix_row in self.pixels)
-
-    # dt is the number of cycles since the last update
-    def update(self, dt):
-        self.modeclock += dt
-        if self.mode == 2:
-            # OAM read mode
-            if self.modeclock >= 80:
-                self.modeclock = 0
-                self.mode = 3
-        elif self.mode == 3:
-            # VRAM read mode
-            if self.modeclock >= 172:
-                self.write_scanline()
-
-                self.modeclock = 0
-                self.mode = 0
-        elif self.mode == 0:
-            # HBLANK
-            if self.modeclock >= 204:
-                self.modeclock = 0
-                self.line += 1
-                if self.line == 143:
-                    # Move to VBLANK
-                    self.mode = 1
-
-                    # Trigger vblank interrupt
-                    self.cpu.int_vblank()
-                else:
-                    self.mode = 2
-        elif self.mode == 1:
-            # VBLANK for equivalent of 10 lines
-            if self.modeclock >= 456:
-                self.modeclock = 0
-                self.line += 1
-                if self.line > 153:
-                    # Done with VBLANK
-                    self.mode = 2
-                    self.line = 0
-
-        # Update MMIO registers
-        self.ram.mmio[0x44] = self.line
-
-    def write_scanline(self):
-        flags = self.ram.mmio[0x40]
-        scy = self.ram.mmio[0x42]
-        scx = self.ram.mmio[0x43]
-
-        # print "scy: %d, scx: %d" % (scy, scx)
+        shades = self.shades()
+        return '\n'.join(''.join(str(p) for p in shades[line * 160 : (line + 1) * 160])
+                         for line in range(144))
+
+    def frame_array(self):
+        # The framebuffer as a (144, 160) numpy array, sharing its memory
+        import numpy
+        return numpy.frombuffer(self.framebuffer, dtype=numpy.uint8).reshape(144, 160)
+
+    # (r, g, b) for each shade, from white to black
+    shade_rgb = ((0xFF, 0xFF, 0xFF), (0xAA, 0xAA, 0xAA), (0x55, 0x55, 0x55), (0x00, 0x00, 0x00))
+
+    def palette_table(self, palettes):
+        # Table for bytearray.translate from pixels to shades, for a line
+        # drawn with palettes (BGP, OBP0, OBP1)
+        table = self.palette_tables.get(palettes)
+        if table is None:
+            if len(self.palette_tables) >= 256:
+                self.palette_tables.clear()
+            shades_by_palette = tuple(palettes) + (0,) # BLANK is always shade 0
+            table = bytes(bytearray((shades_by_palette[(p >> 2) & 3] >> ((p & 3) * 2)) & 3
+                                    for p in range(256)))
+            self.palette_tables[palettes] = table
+        return table
+
+    def shades(self):
+        # The screen as a bytearray of shades (0-3), one per pixel
+        out = bytearray(160 * 144)
+        line = 0
+        while line < 144:
+            # Runs of lines with the same palettes are converted together
+            palettes = self.line_palettes[line]
+            end = line + 1
+            while end < 144 and self.line_palettes[end] == palettes:
+                end += 1
+            out[line * 160 : end * 160] = self.framebuffer[line * 160 : end * 160].translate(
+                self.palette_table(palettes))
+            line = end
+        return out
+
+    def rgb(self, colors=None, alpha=False):
+        # The screen as a bytearray of 8 bit RGB, or RGBA with alpha=True.
+        # colors gives (r, g, b) for each shade, by default shade_rgb.
+        if colors is None:
+            colors = self.shade_rgb
+        shades = self.shades()
+        channels = 4 if alpha else 3
+        out = bytearray(160 * 144 * channels)
+        for c in range(3):
+            table = bytes(bytearray(colors[p][c] if p < 4 else 0 for p in range(256)))
+            out[c::channels] = shades.translate(table)
+        if alpha:
+            out[3::4] = b'\xff' * (160 * 144)
+        return out
+
+    def position(self):
+        # Current (line, mode)
+        if not self.enabled:
+            return 0, 0
+        pos = (self.cpu.clock - self.frame_start) % self.frame_cycles
+        line = pos // self.line_cycles
+        return self.position_at(line, pos - line * self.line_cycles)
+
+    def position_at(self, line, dot):
+        # (line, mode) at a dot (cycle) of a line
+        if line >= 144:
+            return line, 1
+        if dot < 80:
+            return line, 2
+        elif dot < self.hblank_start:
+            return line, 3
+        return line, 0
+
+    def read_ly(self):
+        if not self.enabled:
+            return 0
+        return ((self.cpu.clock - self.frame_start) % self.frame_cycles) // self.line_cycles
+
+    def write_ly(self, d):
+        # Read only
+        pass
+
+    def read_stat(self):
+        line, mode = self.position()
+        stat = 0x80 | (self.ram.mmio[0x41] & 0x78) | mode
+        if line == self.ram.mmio[0x45]:
+            stat |= 0x04
+        return stat
+
+    def write_stat(self, d):
+        # Only the interrupt enable bits are writable
+        high = self.stat_high(*self.position())
+        self.ram.mmio[0x41] = d & 0x78
+        self.stat_changed(high)
+
+    def write_lyc(self, d):
+        high = self.stat_high(*self.position())
+        self.ram.mmio[0x45] = d
+        self.stat_changed(high)
+
+    # STAT interrupt enable bit for each mode (mode 3 has none)
+    stat_mode_bits = (0x08, 0x10, 0x20, 0x00)
+
+    def stat_high(self, line, mode):
+        # Whether the STAT interrupt signal is up at (line, mode). It's the
+        # OR of the enabled sources, and the interrupt is raised when it
+        # goes from low to high.
+        stat = self.ram.mmio[0x41]
+        if stat & 0x40 and line == self.ram.mmio[0x45]:
+            return True
+        return bool(stat & self.stat_mode_bits[mode])
+
+    def stat_changed(self, high):
+        # After a STAT or LYC write, given whether the signal was up before
+        if self.enabled and not high and self.stat_high(*self.position()):
+            self.cpu.int_lcds()
+        self.schedule_stat(self.cpu.clock)
+
+    def schedule_stat(self, now):
+        # Schedule the next time after now that the STAT signal goes up.
+        # It can only change where a mode or line starts, so those are
+        # stepped through for up to a frame. Nothing is scheduled when no
+        # source is enabled.
+        if not self.enabled or not self.ram.mmio[0x41] & 0x78:
+            self.cpu.cancel('stat')
+            return
+        pos = (now - self.frame_start) % self.frame_cycles
+        frame_base = now - pos
+        line = pos // self.line_cycles
+        dot = pos - line * self.line_cycles
+        high = self.stat_high(*self.position_at(line, dot))
+        for i in range(3 * 144 + 10 + 1):
+            # Start of the next mode or line
+            if line % 154 < 144 and dot < 80:
+                dot = 80
+            elif line % 154 < 144 and dot < self.hblank_start:
+                dot = self.hblank_start
+            else:
+                line += 1
+                dot = 0
+            if self.stat_high(*self.position_at(line % 154, dot)):
+                if not high:
+                    self.cpu.schedule('stat', frame_base + line * self.line_cycles + dot, self.stat_interrupt)
+                    return
+                high = True
+            else:
+                high = False
+        self.cpu.cancel('stat')
+
+    def stat_interrupt(self, when):
+        self.cpu.int_lcds()
+        self.schedule_stat(when)
+
+    def write_lcdc(self, d):
+        self.ram.mmio[0x40] = d
+        if self.enabled and not d & GPUFlags.DISPON:
+            self.lcd_off()
+        elif not self.enabled and d & GPUFlags.DISPON:
+            self.lcd_on()
+
+    def lcd_off(self):
+        # The screen goes blank, so logged lines needn't be drawn
+        self.pending = []
+        self.cpu.cancel('gpu')
+        self.cpu.cancel('stat')
+        self.enabled = False
+        self.framebuffer[:] = bytearray([GPUPalette.BLANK << 2]) * (160 * 144)
+        self.drawn = True
+
+    def lcd_on(self):
+        self.enabled = True
+        self.frame_start = self.cpu.clock
+        self.schedule_hblank(0)
+        self.schedule_stat(self.cpu.clock)
+
+    def schedule_hblank(self, line):
+        self.cpu.schedule('gpu', self.frame_start + line * self.line_cycles + self.hblank_start, self.hblank)
+
+    def hblank(self, when):
+        # End of mode 3, the line is drawn
+        self.line = ((when - self.frame_start) % self.frame_cycles) // self.line_cycles
+        if self.drawing:
+            self.pending.append((self.line, self.registers()))
+        if self.line < 143:
+            self.schedule_hblank(self.line + 1)
+        else:
+            self.cpu.schedule('gpu', self.frame_start + 144 * self.line_cycles, self.vblank)
+
+    def vblank(self, when):
+        # Draw the frame, trigger vblank interrupt, and wait out the 10
+        # VBLANK lines
+        self.render_pending()
+        self.drawn = self.drawing
+        self.cpu.int_vblank()
+        self.frame_start += self.frame_cycles
+
+        self.frames += 1
+        self.drawing = self.requested or (self.render_every > 0 and self.frames % self.render_every == 0)
+        self.requested = False
+        self.schedule_hblank(0)
+
+    def registers(self):
+        # LCDC, SCY, SCX, WY, WX, BGP, OBP0, OBP1
+        mmio = self.ram.mmio
+        return (mmio[0x40], mmio[0x42], mmio[0x43], mmio[0x4A], mmio[0x4B],
+                mmio[0x47], mmio[0x48], mmio[0x49])
+
+    def render_pending(self):
+        # Draw the lines logged so far, e.g. to look at a frame before it's
+        # finished
+        if self.pending:
+            lines = self.pending
+            self.pending = []
+            self.render_lines(lines)
+
+    def render_frame(self):
+        # Draw the whole screen from the current registers
+        registers = self.registers()
+        self.render_lines([(line, registers) for line in range(144)])
+        self.drawn = True
+
+    def render_lines(self, lines):
+        # lines is a list of (line, registers)
+        for line, registers in lines:
+            self.write_scanline(line, registers)
+
+    def decode_tiles(self):
+        # Decode the tiles written since the last line into rows of 8 colour
+        # indices, left to right, plus the same rows mirrored for x-flipped
+        # sprites
+        vram = self.ram.vram
+        rows = self.tile_rows
+        flipped = self.tile_rows_flipped
+        for tile in self.ram.dirty_tiles:
+            for pix_line in range(8):
+                tile_lo = vram[tile * 0x10 + pix_line * 2]
+                tile_hi = vram[tile * 0x10 + pix_line * 2 + 1]
+                row = [((tile_hi >> bit) & 1) << 1 | ((tile_lo >> bit) & 1) for bit in range(7, -1, -1)]
+                rows[tile * 8 + pix_line] = row
+                flipped[tile * 8 + pix_line] = row[::-1]
+        self.ram.dirty_tiles.clear()
+
+    def tile_line(self, map_offset, map_line, pix_line, first, count, flags):
+        # count tiles of a map row from first (wrapping at 32), as one list
+        # of colour indices
+        tiles = self.ram.vram[map_offset + map_line * 32 : map_offset + (map_line + 1) * 32]
+        rows = self.tile_rows
+        out = []
+        for i in range(first, first + count):
+            tile_no = tiles[i & 31]
+            # Account for different location of tileset 1
+            if (flags & GPUFlags.BGSET) == 0 and tile_no < 0x80:
+                tile_no += 0x100
+            out.extend(rows[tile_no * 8 + pix_line])
+        return out
+
+    def sprite_lines(self, flags):
+        # The sprites on each line as (x, OAM index), in priority order:
+        # lower x first, then lower index. Like the hardware, only the
+        # first 10 sprites in OAM on a line are drawn. Worked out again
+        # when OAM or the sprite size changes.
+        sprite_height = 16 if flags & GPUFlags.SPSZ else 8
+        if self.ram.oam_dirty or sprite_height != self.sprite_height:
+            oam = self.ram.sprite_info
+            lines = [[] for line in range(144)]
+            for sprite_index in range(40):
+                y_pos = oam[sprite_index * 4] - 16
+                for line in range(max(y_pos, 0), min(y_pos + sprite_height, 144)):
+                    if len(lines[line]) < 10:
+                        lines[line].append((oam[sprite_index * 4 + 1], sprite_index))
+            for sprites in lines:
+                sprites.sort()
+            self.line_sprites = lines
+            self.sprite_height = sprite_height
+            self.ram.oam_dirty = False
+        return self.line_sprites
+
+    def write_scanline(self, line, registers):
+        if self.ram.dirty_tiles:
+            self.decode_tiles()
+        flags, scy, scx, wy, wx, bg_pallette, obp0, obp1 = registers
+        self.line_palettes[line] = (bg_pallette, obp0, obp1)
+
         if flags & GPUFlags.BGON == GPUFlags.BGON:
             # Display background
-            bg_pallette = self.ram.mmio[0x47]
-
             if (flags & GPUFlags.BGMAP) == 0:
                 map_offset = 0x1800
             else:
                 map_offset = 0x1C00
 
-            map_line = ((self.line + scy) & 0xFF) >> 3
-            pix_line = ((self.line + scy) & 0xFF) & 7
-            # The tiles for this line
-            # Each line consists of 32 tileset indices
-            tiles = self.ram.vram[map_offset + map_line * 32 : map_offset + (map_line + 1) * 32]
-
-            for pix in range(160):
-                tile_index = ((pix + scx) & 0xFF) >> 3
-                tile_bit = 7 - (((pix + scx) & 0xFF) & 7)
-
-                tile_no = tiles[tile_index]
-
-                # Account for different location of tileset 1
-                if (flags & GPUFlags.BGSET) == 0 and tile_no < 0x80:
-                    tile_no += 0x100
-
-                tile_lo = self.ram.vram[tile_no * 0x10 + pix_line * 2]
-                tile_hi = self.ram.vram[tile_no * 0x10 + pix_line * 2 + 1]
-
-                pix_hi = ((tile_hi & (1 << tile_bit)) >> tile_bit)
-                pix_lo = ((tile_lo & (1 << tile_bit)) >> tile_bit)
-
-                pallette_index = pix_hi * 2 + pix_lo 
-                self.pixels[self.line][pix] = (bg_pallette >> (pallette_index * 2)) & 3
-        if (flags & GPUFlags.WINON) == GPUFlags.WINON:
-            # Window layer
-            x_pos = self.ram.read(0xFF4B) - 7
-            y_pos = self.ram.read(0xFF4A)
-            
-            if (flags & GPUFlags.WINMAP) == 0:
-                map_offset = 0x1800
+            map_line = ((line + scy) & 0xFF) >> 3
+            pix_line = ((line + scy) & 0xFF) & 7
+            # 21 tiles cover the 160 pixels when scx isn't a multiple of 8
+            row = self.tile_line(map_offset, map_line, pix_line, scx >> 3, 21, flags)
+            fine_x = scx & 7
+            # Colour indices of the background and window, for sprite priority
+            bg_indices = row[fine_x : fine_x + 160]
+
+            if (flags & GPUFlags.WINON) == GPUFlags.WINON:
+                # Window layer
+                x_pos = wx - 7
+                y_pos = wy
+
+                if (flags & GPUFlags.WINMAP) == 0:
+                    map_offset = 0x1800
+                else:
+                    map_offset = 0x1C00
+
+                if line >= y_pos and x_pos < 160:
+                    map_line = (line - y_pos) >> 3
+                    pix_line = (line - y_pos) & 7
+
+                    row = self.tile_line(map_offset, map_line, pix_line, 0, (167 - x_pos) >> 3, flags)
+                    # wx < 7 starts the window left of the screen
+                    skip = max(-x_pos, 0)
+                    x_pos = max(x_pos, 0)
+                    bg_indices[x_pos:] = row[skip : skip + 160 - x_pos]
+            # GPUPalette.BG is 0, so these are the pixels as they are
+            line_pixels = bytearray(bg_indices)
+        else:
+            # With the background off, background and window are blank
+            bg_indices = [0] * 160
+            line_pixels = bytearray([GPUPalette.BLANK << 2]) * 160
+        if (flags & GPUFlags.SPON) == GPUFlags.SPON:
+            # Draw sprites, highest priority first. The first opaque sprite
+            # pixel at each x wins, and if that sprite is behind the
+            # background it only shows where the background is colour 0.
+            if flags & GPUFlags.SPSZ:
+                # 8x16 mode, the top tile is the even one of the pair
+                sprite_height = 16
+                tile_mask = 0xFE
             else:
-                map_offset = 0x1C00
-
-            bg_pallette = self.ram.mmio[0x47]
-
-            if self.line >= y_pos:
-                map_line = (self.line - y_pos) / 8
-                pix_line = (self.line - y_pos) & 7
-
-                tiles = self.ram.vram[map_offset + map_line * 32 : map_offset + (map_line + 1) * 32]
+                sprite_height = 8
+                tile_mask = 0xFF
+            drawn = [False] * 160
+            for x_pos, sprite_index in self.sprite_lines(flags)[line]:
+                sprite_off = 0x4 * sprite_index
+                y_pos = self.ram.sprite_info[sprite_off] - 16
+                x_pos -= 8
+                tile_index = self.ram.sprite_info[sprite_off+2] & tile_mask
+                sprite_flags = self.ram.sprite_info[sprite_off+3]
 
-                for pix in range(x_pos, 160):
-                    tile_index = (pix - x_pos) >> 3
-                    tile_bit = 7 - ((pix - x_pos) & 7)
+                above = ((sprite_flags & 0x80) == 0)
+                y_flip = ((sprite_flags & 0x40) == 0x40)
+                x_flip = ((sprite_flags & 0x20) == 0x20)
+                pal_num = ((sprite_flags & 0x10) >> 4)
+                if pal_num == 0:
+                    pallette = GPUPalette.OBJ0 << 2
+                else:
+                    pallette = GPUPalette.OBJ1 << 2
 
-                    tile_no = tiles[tile_index]
+                # The rows of consecutive tiles follow on from each other
+                # in tile_rows, so this also covers both tiles of a 8x16
+                # sprite, flipped as a whole
+                if not y_flip:
+                    pix_line = line - y_pos
+                else:
+                    pix_line = sprite_height - 1 - (line - y_pos)
+                if x_flip:
+                    row = self.tile_rows_flipped[tile_index * 8 + pix_line]
+                else:
+                    row = self.tile_rows[tile_index * 8 + pix_line]
+                for pix in range(max(x_pos, 0), min(x_pos + 8, 160)):
+                    pallette_index = row[pix - x_pos]
+                    if pallette_index != 0 and not drawn[pix]:
+                        drawn[pix] = True
+                        if (above or bg_indices[pix] == 0):
+                            line_pixels[pix] = pallette | pallette_index
+
+        self.framebuffer[line * 160 : (line + 1) * 160] = line_pixels
+
+class gb_timer(object):
+    # DIV and TIMA are worked out from the cpu clock when they're read, so
+    # nothing happens per instruction. The only scheduled work is TIMA
+    # overflowing, which reloads it from TMA and raises the interrupt.
+    periods = (1024, 16, 64, 256) # Cycles per TIMA tick for each TAC speed
 
-                    if (flags & GPUFlags.BGSET) == 0 and tile_no < 0x80:
-                        tile_no += 0x100
+    def __init__(self, cpu_obj, ram_obj):
+        self.cpu = cpu_obj
+        self.ram = ram_obj
+        self.div_base = 0 # Clock at which the internal divider was 0
+        self.tima_base = 0 # TIMA as of tima_base_clock
+        self.tima_base_clock = 0
+
+        self.ram.io_read[0x04] = self.read_div
+        self.ram.io_write[0x04] = self.write_div
+        self.ram.io_read[0x05] = self.read_tima
+        self.ram.io_write[0x05] = self.write_tima
+        self.ram.io_write[0x07] = self.write_tac
+
+    def read_div(self):
+        return ((self.cpu.clock - self.div_base) >> 8) & 0xFF
+
+    def read_tima(self):
+        tac = self.ram.mmio[0x07]
+        if not tac & 0x4:
+            return self.tima_base
+        # TIMA ticks whenever the divider passes a multiple of the period
+        period = self.periods[tac & 3]
+        ticks = ((self.cpu.clock - self.div_base) // period -
+                 (self.tima_base_clock - self.div_base) // period)
+        return (self.tima_base + ticks) & 0xFF
+
+    def rebase(self):
+        # Fold the ticks so far into tima_base, e.g. before the divider or
+        # period changes
+        self.tima_base = self.read_tima()
+        self.tima_base_clock = self.cpu.clock
+
+    def schedule_overflow(self):
+        tac = self.ram.mmio[0x07]
+        if not tac & 0x4:
+            self.cpu.cancel('timer')
+            return
+        period = self.periods[tac & 3]
+        ticks = (self.tima_base_clock - self.div_base) // period + 0x100 - self.tima_base
+        self.cpu.schedule('timer', self.div_base + ticks * period, self.overflow)
+
+    def overflow(self, when):
+        self.tima_base = self.ram.mmio[0x06]
+        self.tima_base_clock = when
+        self.cpu.int_timer()
+        self.schedule_overflow()
+
+    def write_div(self, d):
+        # Any write resets the divider
+        self.rebase()
+        self.div_base = self.cpu.clock
+        self.schedule_overflow()
+
+    def write_tima(self, d):
+        self.tima_base = d
+        self.tima_base_clock = self.cpu.clock
+        self.schedule_overflow()
+
+    def write_tac(self, d):
+        self.rebase()
+        self.ram.mmio[0x07] = d
+        self.schedule_overflow()
+
+class gb_serial(object):
+    # Serial port. A transfer started with the internal clock completes
+    # after 8 bits at 8192Hz, when the byte sent is added to output, the
+    # byte received (0xFF with nothing connected) lands in SB and the
+    # serial interrupt is raised.
+    transfer_cycles = 8 * 512
 
-                    tile_lo = self.ram.vram[tile_no * 0x10 + pix_line * 2]
-                    tile_hi = self.ram.vram[tile_no * 0x10 + pix_line * 2 + 1]
+    def __init__(self, cpu_obj, ram_obj):
+        self.cpu = cpu_obj
+        self.ram = ram_obj
+        self.output = bytearray() # Bytes sent since the last flush
+        self.sink = None # If set, flush() writes output to sink.write()
+        self.link = None # Link cable, see link.py
 
-                    pix_hi = ((tile_hi & (1 << tile_bit)) >> tile_bit)
-                    pix_lo = ((tile_lo & (1 << tile_bit)) >> tile_bit)
+        self.ram.io_write[0x02] = self.write_sc
 
-                    pallette_index = pix_hi * 2 + pix_lo
-                    self.pixels[self.line][pix] = (bg_pallette >> (pallette_index * 2)) & 3
-        if (flags & GPUFlags.SPON) == GPUFlags.SPON:
-            # Draw sprites
-            sprite_mode = flags & GPUFlags.SPSZ
-            for sprite_index in range(40):
-                sprite_off = 0x4 * sprite_index
-                y_pos = self.ram.sprite_info[sprite_off] - 16
-                x_pos = self.ram.sprite_info[sprite_off+1] - 8
-                tile_index = self.ram.sprite_info[sprite_off+2]
-                sprite_flags = self.ram.sprite_info[sprite_off+3]
+    def write_sc(self, d):
+        self.ram.mmio[0x02] = d | 0x7E
+        if d & 0x81 == 0x81:
+            self.cpu.schedule('serial', self.cpu.clock + self.transfer_cycles, self.transfer_done)
+        else:
+            # With the external clock the transfer waits for a peer that
+            # never comes
+            self.cpu.cancel('serial')
 
-                if sprite_mode == 0:
-                    # 8x8 mode
-                    above = ((sprite_flags & 0x80) == 0)
-                    y_flip = ((sprite_flags & 0x40) == 0x40)
-                    x_flip = ((sprite_flags & 0x20) == 0x20)
-                    pal_num = ((sprite_flags & 0x10) / 0x10)
-                    if pal_num == 0:
-                        pallette = self.ram.mmio[0x48]
-                    else:
-                        pallette = self.ram.mmio[0x49]
-
-                    if y_pos <= self.line and y_pos > self.line - 8:
-                        if not y_flip:
-                            pix_line = self.line - y_pos
-                        else:
-                            pix_line = 7 - (self.line - y_pos)
-                        for pix in range(max(x_pos, 0), min(x_pos + 8, 159)):
-                            if x_flip:
-                                tile_bit = pix - x_pos
-                            else:
-                                tile_bit = 7 - (pix - x_pos)
-
-                            tile_lo = self.ram.vram[tile_index * 0x10 + pix_line * 2]
-                            tile_hi = self.ram.vram[tile_index * 0x10 + pix_line * 2 + 1]
-
-                            pix_hi = ((tile_hi & (1 << tile_bit)) >> tile_bit)
-                            pix_lo = ((tile_lo & (1 << tile_bit)) >> tile_bit)
-
-                            pallette_index = pix_hi * 2 + pix_lo
-                            if pallette_index != 0:
-                                color = (pallette >> (pallette_index * 2)) & 3
-                                
-                                if (above or self.pixels[self.line][pix] == 0):
-                                    self.pixels[self.line][pix] = color
-                else:
-                    # 8x16 mode
-                    pass
+    def transfer_done(self, when):
+        if self.link is None:
+            self.complete(0xFF)
+            return
+        # A link can return None to finish the transfer itself later
+        received = self.link.transfer(self, self.ram.mmio[0x01])
+        if received is not None:
+            self.complete(received)
+
+    def complete(self, received):
+        # Finish the transfer in progress, shifting in received
+        self.output.append(self.ram.mmio[0x01])
+        self.ram.mmio[0x01] = received
+        self.ram.mmio[0x02] &= 0x7F
+        self.cpu.int_serial()
+
+    def flush(self):
+        # Hand output to the sink in one write
+        if self.sink is not None and self.output:
+            self.sink.write(bytes(self.output))
+            if hasattr(self.sink, 'flush'):
+                self.sink.flush()
+            del self.output[:]
 
 class gb_joypad(object):
-    def __init__(self):
-        self.right = False
-        self.left = False
-        self.up = False
-        self.down = False
-        self.A = False
-        self.B = False
-        self.start = False
-        self.select = False
-
-    def P14_mask(self):
-        mask = 0xF
-        if self.right:
-            mask &= ~0x1
-        if self.left:
-            mask &= ~0x2
-        if self.up:
-            mask &= ~0x4
-        if self.down:
-            mask &= ~0x8
-        return mask
-
-    def P15_mask(self):
-        mask = 0xF
-        if self.A:
-            mask &= ~0x1
-        if self.B:
-            mask &= ~0x2
-        if self.select:
-            mask &= ~0x4
-        if self.start:
-            mask &= ~0x8
-        return mask
+    # Bits of the buttons mask. Directions are read through P14, the rest
+    # through P15.
+    button_bits = {
+        'right': 0x01,
+        'left': 0x02,
+        'up': 0x04,
+        'down': 0x08,
+        'A': 0x10,
+        'B': 0x20,
+        'select': 0x40,
+        'start': 0x80,
+        }
+
+    def __init__(self, cpu_obj, ram_obj):
+        self.cpu = cpu_obj
+        self.ram = ram_obj
+        self.buttons = 0 # Currently pressed buttons
+        self.pending = 0 # Pressed buttons once everything queued is applied
+        # Input changes waiting for their time to come, as (clock, buttons)
+        self.queue = collections.deque()
+
+        self.ram.io_read[0x00] = self.read_p1
+        self.ram.io_write[0x00] = self.write_p1
+
+    def read_p1(self):
+        select = self.ram.mmio[0x00]
+        lines = 0x0F
+        if not select & 0x10:
+            lines &= ~self.buttons
+        if not select & 0x20:
+            lines &= ~(self.buttons >> 4)
+        return 0xC0 | select | (lines & 0x0F)
+
+    def write_p1(self, d):
+        # Only the line select bits are writable
+        self.ram.mmio[0x00] = d & 0x30
+
+    # Input is queued with the clock it applies at (the current clock if
+    # not given), and applied by a scheduled event. Changes must be queued
+    # in clock order.
+    def set_buttons(self, buttons, clock=None):
+        if clock is None:
+            clock = self.cpu.clock
+        self.pending = buttons
+        self.queue.append((clock, buttons))
+        if len(self.queue) == 1:
+            self.cpu.schedule('joypad', clock, self.apply_input)
+
+    def press(self, button, clock=None):
+        if not self.pending & self.button_bits[button]:
+            self.set_buttons(self.pending | self.button_bits[button], clock)
+
+    def release(self, button, clock=None):
+        if self.pending & self.button_bits[button]:
+            self.set_buttons(self.pending & ~self.button_bits[button], clock)
+
+    def apply_input(self, when):
+        clock, buttons = self.queue.popleft()
+        pressed = buttons & ~self.buttons
+        self.buttons = buttons
+
+        # The interrupt fires when a selected line goes low
+        select = self.ram.mmio[0x00]
+        selected = 0
+        if not select & 0x10:
+            selected |= 0x0F
+        if not select & 0x20:
+            selected |= 0xF0
+        if pressed & selected:
+            self.cpu.int_joypad()
+
+        if self.queue:
+            self.cpu.schedule('joypad', self.queue[0][0], self.apply_input)
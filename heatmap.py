@@ -0,0 +1,176 @@
+import json
+import random
+
+class MemoryHeatmap(object):
+    # Counts memory reads and writes per 256 byte page and per region (ROM
+    # and external RAM banks, VRAM, WRAM, OAM, each IO register, HRAM).
+    #
+    # Counting works by shadowing ram.read/ram.write on the instance, and
+    # only while a sample window is open: out of every interval cycles,
+    # interval * sample_rate are counted, starting at a random point in the
+    # interval. The default interval is one frame, so the random start is
+    # what spreads the windows over every line rather than the same few.
+    # Outside the windows, or without a heatmap at all, memory accesses
+    # don't go through here.
+    def __init__(self, gb_obj, sample_rate=0.1, interval=70224, seed=None):
+        self.gb = gb_obj
+        self.ram = gb_obj.ram
+        self.cpu = gb_obj.cpu
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.random = random.Random(seed)
+        self.running = False
+        self.sampling = False
+        self.clear()
+
+    def clear(self):
+        self.page_reads = [0] * 0x100
+        self.page_writes = [0] * 0x100
+        self.io_reads = [0] * 0x80
+        self.io_writes = [0] * 0x80
+        # (region, bank) -> count, for the banked areas
+        self.bank_reads = {}
+        self.bank_writes = {}
+        self.sampled_cycles = 0 # Cycles inside sample windows
+        self.elapsed_cycles = 0 # Cycles run while started, up to the last stop
+        self.start_clock = self.cpu.clock
+
+    def start(self):
+        self.running = True
+        self.start_clock = self.cpu.clock
+        self.schedule_window(self.cpu.clock)
+
+    def stop(self):
+        self.running = False
+        self.cpu.cancel('heatmap')
+        if self.sampling:
+            self.close_window(self.cpu.clock)
+        self.elapsed_cycles += self.cpu.clock - self.start_clock
+
+    def window_length(self):
+        return min(self.interval, max(1, int(self.interval * self.sample_rate)))
+
+    def schedule_window(self, interval_start):
+        # Open the window for the interval starting at interval_start
+        self.interval_start = interval_start
+        offset = self.random.randrange(self.interval - self.window_length() + 1)
+        self.cpu.schedule('heatmap', interval_start + offset, self.open_window)
+
+    def open_window(self, when):
+        self.ram.read = self.read
+        self.ram.write = self.write
+        self.sampling = True
+        self.window_start = when
+        self.cpu.schedule('heatmap', when + self.window_length(), self.close_window)
+
+    def close_window(self, when):
+        del self.ram.read
+        del self.ram.write
+        self.sampling = False
+        self.sampled_cycles += when - self.window_start
+        if self.running:
+            self.schedule_window(self.interval_start + self.interval)
+
+    def bank(self, p):
+        # (region, bank) for an address in a banked area, or None
+        ram = self.ram
+        if p < 0x4000:
+            return 'ROM', ram.rom0_index
+        elif p < 0x8000:
+            return 'ROM', ram.romn_index
+        elif 0xA000 <= p < 0xC000:
+            if ram.eram_mapped:
+                return 'ERAM', (ram.eram_offset + 0xA000) // 0x2000
+            return 'ERAM', None
+        return None
+
+    def read(self, p):
+        self.page_reads[p >> 8] += 1
+        if 0xFF00 <= p < 0xFF80:
+            self.io_reads[p - 0xFF00] += 1
+        else:
+            key = self.bank(p)
+            if key is not None:
+                self.bank_reads[key] = self.bank_reads.get(key, 0) + 1
+        return type(self.ram).read(self.ram, p)
+
+    def write(self, p, d):
+        self.page_writes[p >> 8] += 1
+        if 0xFF00 <= p < 0xFF80:
+            self.io_writes[p - 0xFF00] += 1
+        else:
+            key = self.bank(p)
+            if key is not None:
+                self.bank_writes[key] = self.bank_writes.get(key, 0) + 1
+        type(self.ram).write(self.ram, p, d)
+
+    # Fixed regions, as (name, first page, last page)
+    page_regions = (
+        ('VRAM', 0x80, 0x9F),
+        ('WRAM', 0xC0, 0xDF),
+        ('WRAM shadow', 0xE0, 0xFD),
+        ('OAM', 0xFE, 0xFE),
+        )
+
+    def regions(self):
+        # List of (region, reads, writes), in sampled counts
+        out = []
+        for key in sorted(set(self.bank_reads) | set(self.bank_writes), key=str):
+            region, bank = key
+            name = region if bank is None else '%s bank %d' % key
+            if bank is None:
+                name += ' (unmapped)'
+            out.append((name, self.bank_reads.get(key, 0), self.bank_writes.get(key, 0)))
+        for name, first, last in self.page_regions:
+            out.append((name, sum(self.page_reads[first:last + 1]),
+                        sum(self.page_writes[first:last + 1])))
+        for r in range(0x80):
+            if self.io_reads[r] or self.io_writes[r]:
+                out.append(('MMIO %04X' % (0xFF00 + r), self.io_reads[r], self.io_writes[r]))
+        # HRAM and IE share page 0xFF with the IO registers
+        out.append(('HRAM', self.page_reads[0xFF] - sum(self.io_reads),
+                    self.page_writes[0xFF] - sum(self.io_writes)))
+        return out
+
+    def total_cycles(self):
+        # Cycles run while the heatmap was started
+        if self.running:
+            return self.elapsed_cycles + self.cpu.clock - self.start_clock
+        return self.elapsed_cycles
+
+    def sampled_fraction(self):
+        # Share of the run actually sampled, which can differ from
+        # sample_rate, e.g. for a run shorter than an interval
+        total = self.total_cycles()
+        if total <= 0:
+            return 0.0
+        return float(self.sampled_cycles) / total
+
+    def scale(self):
+        # Multiply sampled counts by this to estimate counts for the whole run
+        if self.sampled_cycles <= 0:
+            return 0
+        return float(self.total_cycles()) / self.sampled_cycles
+
+    def table(self):
+        lines = ["%-20s %12s %12s" % ('Region', 'Reads', 'Writes')]
+        for name, reads, writes in sorted(self.regions(), key=lambda r: -(r[1] + r[2])):
+            lines.append("%-20s %12d %12d" % (name, reads, writes))
+        lines.append("")
+        lines.append("%-20s %12s %12s" % ('Page', 'Reads', 'Writes'))
+        for page in range(0x100):
+            if self.page_reads[page] or self.page_writes[page]:
+                lines.append("%04X-%04X            %12d %12d" % (
+                        page << 8, (page << 8) | 0xFF, self.page_reads[page], self.page_writes[page]))
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return json.dumps({
+            'sample_rate': self.sample_rate,
+            'sampled_cycles': self.sampled_cycles,
+            'total_cycles': self.total_cycles(),
+            'regions': [{'region': name, 'reads': reads, 'writes': writes}
+                        for name, reads, writes in self.regions()],
+            'pages': [{'page': page << 8, 'reads': self.page_reads[page], 'writes': self.page_writes[page]}
+                      for page in range(0x100) if self.page_reads[page] or self.page_writes[page]],
+            }, indent=1)
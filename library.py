@@ -0,0 +1,163 @@
+import hashlib
+import json
+import multiprocessing
+import os
+
+from gb import gb_ram
+
+rom_extensions = ('.gb', '.gbc', '.sgb')
+
+def parse_header(rom):
+    # Cartridge header fields of rom (a bytearray) as a dict
+    rom_type = rom[0x147]
+    cgb = rom[0x143]
+    if cgb & 0x80:
+        # The last title byte is the CGB flag on colour carts
+        title = rom[0x134:0x143]
+    else:
+        title = rom[0x134:0x144]
+    title = bytes(title.split(b'\x00')[0]).decode('latin-1').strip()
+
+    header_checksum = 0
+    for b in rom[0x134:0x14D]:
+        header_checksum = (header_checksum - b - 1) & 0xFF
+    global_checksum = (sum(rom) - rom[0x14E] - rom[0x14F]) & 0xFFFF
+
+    mbc = gb_ram.mbc_types.get(rom_type)
+    return {
+        'title': title,
+        'cart_type': rom_type,
+        'mbc': mbc,
+        'supported': mbc is not None,
+        'battery': rom_type in gb_ram.battery_types,
+        'rtc': rom_type in (0x0F, 0x10),
+        'rom_size': 0x8000 << rom[0x148] if rom[0x148] < 9 else None,
+        'ram_size': gb_ram.eram_size(rom_type, rom[0x149]),
+        'cgb': cgb & 0xC0 if cgb & 0x80 else 0, # 0x80 = supports CGB, 0xC0 = CGB only
+        'sgb': rom[0x146] == 0x03,
+        'header_checksum': rom[0x14D],
+        'header_checksum_ok': header_checksum == rom[0x14D],
+        'global_checksum': (rom[0x14E] << 8) | rom[0x14F],
+        'global_checksum_ok': global_checksum == (rom[0x14E] << 8) | rom[0x14F],
+        }
+
+def read_rom(path):
+    # (path, size, mtime, sha1, header) for one file. Runs in the pool.
+    data = open(path, 'rb').read()
+    st = os.stat(path)
+    rom = bytearray(data)
+    if len(rom) < 0x150:
+        header = None
+    else:
+        header = parse_header(rom)
+    return path, st.st_size, st.st_mtime, hashlib.sha1(data).hexdigest(), header
+
+class RomLibrary(object):
+    # Index of the ROMs in a directory. Headers are parsed in a process pool
+    # and cached in index_path (by default an index file in the directory),
+    # keyed by file hash, with each path's size and mtime recorded so
+    # unchanged files aren't read again on the next scan.
+    def __init__(self, directory, index_path=None, processes=None):
+        self.directory = directory
+        if index_path is None:
+            index_path = os.path.join(directory, '.hamster_index.json')
+        self.index_path = index_path
+        self.processes = processes
+        self.headers = {} # sha1 -> header dict
+        self.files = {} # path -> {'size', 'mtime', 'sha1'}
+        self.load_index()
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            index = json.load(open(self.index_path))
+        except (IOError, OSError, ValueError):
+            # Unreadable or corrupt index, rebuild it
+            return
+        self.headers = index.get('headers', {})
+        self.files = index.get('files', {})
+
+    def save_index(self):
+        # Returns False if the index couldn't be written
+        tmp = self.index_path + '.tmp'
+        try:
+            f = open(tmp, 'w')
+            try:
+                json.dump({'headers': self.headers, 'files': self.files}, f, indent=1, sort_keys=True)
+            finally:
+                f.close()
+            os.rename(tmp, self.index_path)
+        except (IOError, OSError):
+            # e.g. a read-only rom directory, so keep the index in memory
+            # only and read the files again on the next run
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def scan(self):
+        # Update the index from the directory, reading only new or changed
+        # files. Returns the list of roms, as from roms().
+        paths = []
+        for root, dirs, names in os.walk(self.directory):
+            for name in names:
+                if os.path.splitext(name)[1].lower() in rom_extensions:
+                    paths.append(os.path.join(root, name))
+
+        stale = []
+        for path in paths:
+            st = os.stat(path)
+            entry = self.files.get(path)
+            if (entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime
+                    or entry['sha1'] not in self.headers):
+                stale.append(path)
+
+        if len(stale) > 1 and self.processes != 1:
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                results = pool.map(read_rom, stale)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [read_rom(path) for path in stale]
+
+        for path, size, mtime, sha1, header in results:
+            self.files[path] = {'size': size, 'mtime': mtime, 'sha1': sha1}
+            self.headers[sha1] = header
+
+        changed = bool(stale)
+        present = set(paths)
+        for path in list(self.files):
+            if path not in present:
+                del self.files[path]
+                changed = True
+        used = set(entry['sha1'] for entry in self.files.values())
+        for sha1 in list(self.headers):
+            if sha1 not in used:
+                del self.headers[sha1]
+
+        if changed:
+            self.save_index()
+        return self.roms()
+
+    def info(self, path):
+        # Header dict for path plus its 'path' and 'sha1', or None if it
+        # isn't in the index or is too short to have a header
+        entry = self.files.get(path)
+        if entry is None or self.headers.get(entry['sha1']) is None:
+            return None
+        info = dict(self.headers[entry['sha1']])
+        info['path'] = path
+        info['sha1'] = entry['sha1']
+        return info
+
+    def roms(self):
+        infos = [self.info(path) for path in sorted(self.files)]
+        return [info for info in infos if info is not None]
+
+    def supported(self):
+        return [info for info in self.roms() if info['supported']]
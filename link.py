@@ -0,0 +1,201 @@
+import socket
+import struct
+
+from gb import gb_serial
+
+class LinkCable(object):
+    # Connects the serial ports of two Gameboy objects in the same process.
+    # Both are run by step()/step_frame() in lockstep windows no longer than
+    # a serial transfer, so when one side finishes clocking a byte out the
+    # other side is at most one transfer behind.
+    def __init__(self, gb_a, gb_b):
+        self.gbs = (gb_a, gb_b)
+        self.window = gb_serial.transfer_cycles
+        gb_a.serial.link = self
+        gb_b.serial.link = self
+
+    def unplug(self):
+        for gb in self.gbs:
+            gb.serial.link = None
+
+    def other(self, serial):
+        if serial is self.gbs[0].serial:
+            return self.gbs[1].serial
+        return self.gbs[0].serial
+
+    def transfer(self, serial, data):
+        # serial finished clocking out data with its internal clock. The
+        # other side's SB always shifts back, but it only completes a
+        # transfer if it was waiting on the external clock.
+        other = self.other(serial)
+        received = other.ram.mmio[0x01]
+        if other.ram.mmio[0x02] & 0x81 == 0x80:
+            other.complete(data)
+        return received
+
+    def step(self, cycles):
+        # Run both Gameboys for cycles
+        a, b = self.gbs
+        end_a = a.cpu.clock + cycles
+        end_b = b.cpu.clock + cycles
+        window = self.window
+        while a.cpu.clock < end_a or b.cpu.clock < end_b:
+            a.run_until(min(a.cpu.clock + window, end_a))
+            b.run_until(min(b.cpu.clock + window, end_b))
+
+    def step_frame(self):
+        self.step(70224)
+        for gb in self.gbs:
+            gb.end_frame()
+
+class SocketLink(object):
+    # Links a Gameboy to a peer in another process (or thread) over a
+    # connected stream socket, e.g. one end of socket.socketpair() or a Unix
+    # domain socket. step()/step_frame() run in windows of window cycles,
+    # and at the end of each window both sides swap one message, so there's
+    # one round trip per window rather than per byte.
+    #
+    # The two sides swap their clocks once on the first step, so each can
+    # turn the other's clock stamps into its own. Each message then holds
+    # the bytes sent with the internal clock during the window and every
+    # value SB had during it, both stamped with the clock. A transfer this
+    # side starts is finished at the end of its window with the peer's SB
+    # as of the transfer's stamp. Bytes the peer sent are shifted in at
+    # their stamp, or straight away if that has passed.
+    hello = struct.Struct('<Q') # clock at connection
+    header = struct.Struct('<HH') # number of bytes sent, number of SB values
+    record = struct.Struct('<QB') # clock, byte
+
+    def __init__(self, gb, sock, window=gb_serial.transfer_cycles):
+        self.gb = gb
+        self.sock = sock
+        self.window = window
+        self.sent = [] # (clock, byte) sent during this window, not finished yet
+        self.sb_log = [] # (clock, SB) during this window, from its start
+        self.incoming = [] # (clock, byte) from the peer, to shift in
+        self.offset = None # Peer clock - our clock, once the hello arrives
+        self.connected = True
+        gb.serial.link = self
+        gb.ram.io_write[0x01] = self.write_sb
+
+    def unplug(self):
+        self.disconnect()
+        self.gb.serial.link = None
+        self.gb.ram.io_write[0x01] = None
+        self.sock.close()
+
+    def disconnect(self):
+        # Carry on as if the cable was pulled out: transfers in progress
+        # get 0xFF, as do any later ones
+        self.connected = False
+        self.gb.cpu.cancel('link')
+        self.incoming = []
+        sent = self.sent
+        self.sent = []
+        for clock, data in sent:
+            self.gb.serial.complete(0xFF)
+
+    def write_sb(self, d):
+        self.gb.ram.mmio[0x01] = d
+        self.sb_log.append((self.gb.cpu.clock, d))
+
+    def transfer(self, serial, data):
+        # Finished in exchange(), once the peer's SB is known
+        if self.connected:
+            self.sent.append((serial.cpu.clock, data))
+            return None
+        return 0xFF
+
+    def complete(self, received, clock):
+        self.gb.serial.complete(received)
+        self.sb_log.append((clock, received))
+
+    def recv_exactly(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def recv_records(self, count):
+        data = self.recv_exactly(count * self.record.size) if count else b''
+        if data is None:
+            return None
+        return [self.record.unpack_from(data, i * self.record.size) for i in range(count)]
+
+    def connect(self):
+        # Swap clocks at the start of the first linked step, where both
+        # sides' lockstep windows begin, so the offset holds from then on
+        try:
+            self.sock.sendall(self.hello.pack(self.gb.cpu.clock))
+            data = self.recv_exactly(self.hello.size)
+        except socket.error:
+            data = None
+        if data is None:
+            self.disconnect()
+            return
+        self.offset = self.hello.unpack(data)[0] - self.gb.cpu.clock
+        self.sb_log = [(self.gb.cpu.clock, self.gb.ram.mmio[0x01])]
+
+    def exchange(self):
+        clock = self.gb.cpu.clock
+        msg = [self.header.pack(len(self.sent), len(self.sb_log))]
+        msg.extend(self.record.pack(*r) for r in self.sent)
+        msg.extend(self.record.pack(*r) for r in self.sb_log)
+        try:
+            self.sock.sendall(b''.join(msg))
+            data = self.recv_exactly(self.header.size)
+            if data is not None:
+                sent_count, sb_count = self.header.unpack(data)
+                peer_sent = self.recv_records(sent_count)
+                peer_sb_log = self.recv_records(sb_count)
+        except socket.error:
+            data = None
+        if data is None or peer_sent is None or peer_sb_log is None:
+            self.disconnect()
+            return
+
+        # The next window's SB values start from the current one
+        self.sb_log = [(clock, self.gb.ram.mmio[0x01])]
+        # Finish our transfers with the peer's SB at the time
+        sent = self.sent
+        self.sent = []
+        for sent_clock, data in sent:
+            self.complete(self.peer_sb(peer_sb_log, sent_clock + self.offset), clock)
+        # Shift in the peer's bytes
+        for peer_clock, data in peer_sent:
+            self.incoming.append((max(peer_clock - self.offset, clock), data))
+        if self.incoming:
+            self.gb.cpu.schedule('link', self.incoming[0][0], self.receive)
+
+    def peer_sb(self, sb_log, peer_clock):
+        # The peer's SB at peer_clock, from its values over the window
+        sb = sb_log[0][1] if sb_log else 0xFF
+        for clock, value in sb_log:
+            if clock > peer_clock:
+                break
+            sb = value
+        return sb
+
+    def receive(self, when):
+        clock, data = self.incoming.pop(0)
+        if self.gb.ram.mmio[0x02] & 0x81 == 0x80:
+            # Waiting on the external clock
+            self.complete(data, when)
+        if self.incoming:
+            self.gb.cpu.schedule('link', self.incoming[0][0], self.receive)
+
+    def step(self, cycles):
+        if self.connected and self.offset is None:
+            self.connect()
+        end = self.gb.cpu.clock + cycles
+        while self.gb.cpu.clock < end:
+            self.gb.run_until(min(self.gb.cpu.clock + self.window, end))
+            if self.connected:
+                self.exchange()
+
+    def step_frame(self):
+        self.step(70224)
+        self.gb.end_frame()
@@ -5,10 +5,14 @@ import sys
 def main(rom_file):
     game = Gameboy()
     disp = Display(game)
-    game.load_rom(rom_file)
+    # Keep the cartridge clock in step with real time between sessions
+    game.ram.rtc_wall_clock = True
+    game.load_rom(rom_file, save=True)
+    # Show anything the game sends over the link port (e.g. test roms)
+    game.serial.sink = getattr(sys.stdout, 'buffer', sys.stdout)
     def advance():
         game.step_frame()
-        disp.update(game.gpu.pixels)
+        disp.update(game.gpu.shades())
         disp.root.after(1, advance)
     disp.root.after(1, advance)
     disp.root.mainloop()